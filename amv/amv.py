@@ -6,41 +6,94 @@ import sys
 import time
 from collections import OrderedDict
 from configparser import ConfigParser
-from queue import Queue
+from queue import Empty, Queue
 from threading import Event, Thread
 
+from . import coordination
 from . import database
-from .hashing import ed2k_of_path
+from . import file_identity
+from . import manifest
+from . import watch
+from .exceptions import ManifestException
+from .hashing import DIGESTS, crc32_tag_of_path, digests_of_path
 from .network.client import UdpClient
 
+HAND_OVER_POLL_INTERVAL = 5
+
 
 def main():
     shutdown_event = _setup_shutdown_event()
 
     args_files, args_directory, args = _parse_args()
-    config = _read_config()
 
-    files_and_dirs = _remove_duplicates(args_files)
-    files = _get_paths_to_register(files_and_dirs)
-    file_info_queue = Queue()
+    if args.hash_only:
+        _write_manifest(shutdown_event, args, _get_paths_to_register(_remove_duplicates(args_files)))
+        return
 
-    with database.open_database() as cursor:
-        if args.db_report:
-            file_infos_from_database = database.get_unregistered_files(cursor)
-            _add_unregistered_files(file_info_queue, file_infos_from_database)
+    config = _read_config()
+
+    if args.from_manifest:
+        file_infos_from_manifests, relative_paths = _read_manifests(args)
+        files_and_dirs = list(relative_paths)
+        files = []
+    else:
+        file_infos_from_manifests, relative_paths = [], {}
+        files_and_dirs = _remove_duplicates(args_files)
+        files = _get_paths_to_register(files_and_dirs)
+
+    if args.watch:
+        _check_that_watch_is_supported()
+
+    with database.open_database() as cursor, coordination.SessionLock() as session_lock:
+        if session_lock.try_acquire() and args.db_report:
+            file_infos_from_database = _prune_stale_files(cursor, database.get_unregistered_files(cursor), files)
+            # Files that are already in the database are registered from there, instead of being hashed again
+            files = _remove_files_in_database(files, file_infos_from_database)
         else:
             file_infos_from_database = []
 
-        thread = _start_worker_thread(shutdown_event, args.watched, args.external, file_info_queue, files)
-        with UdpClient(shutdown_event, args.verbose, config, file_info_queue) as client:
-            file_infos_not_found = client.register_file_infos()
-        thread.join()
+        file_infos_not_found, file_infos_to_hand_over = _register_files(
+            shutdown_event, args, config, cursor, session_lock, file_infos_from_database + file_infos_from_manifests,
+            files, args_directory)
 
-        _add_unregistered_files_to_db(cursor, file_infos_from_database, file_infos_not_found)
-        _remove_registered_files_from_db(cursor, file_infos_from_database, file_infos_not_found)
+        # The files are moved first, so that the database gets the paths they end up at
+        moved_paths = _move_sources(args, files_and_dirs, relative_paths, args_directory)
+        _hand_over_file_infos(cursor, file_infos_to_hand_over, moved_paths)
+        file_infos_not_found += _register_queued_file_infos(shutdown_event, args, config, cursor, session_lock)
 
-    if args.move:
-        _move_files(files_and_dirs, args_directory)
+        _update_database(cursor, args, file_infos_from_database, file_infos_not_found, moved_paths)
+
+
+# pylint: disable=too-many-arguments
+def _register_files(shutdown_event, args, config, cursor, session_lock, file_infos, files, directory):
+    file_info_queue = Queue()
+    _add_file_infos(file_info_queue, file_infos)
+    if args.watch:
+        thread = _start_watch_thread(
+            shutdown_event, args.watched, args.external, args.digests, file_info_queue, args.watch, directory)
+    else:
+        thread = _start_worker_thread(
+            shutdown_event, args.watched, args.external, args.digests, file_info_queue, files)
+
+    file_infos_not_found = []
+    file_infos_to_hand_over = []
+    if session_lock.acquired:
+        file_infos_not_found = _register_own_file_infos(
+            shutdown_event, args, config, cursor, session_lock, file_info_queue)
+    elif args.watch:
+        file_infos_not_found = _hand_over_watched_file_infos(
+            shutdown_event, args, config, cursor, session_lock, file_info_queue)
+    else:
+        file_infos_to_hand_over = list(iter(file_info_queue.get, None))
+    thread.join()
+
+    return file_infos_not_found, file_infos_to_hand_over
+
+
+def _hand_over_file_infos(cursor, file_infos, moved_paths):
+    if file_infos:
+        print("Another amv process is registering files, handing the files over to it")
+        database.add_queued_files(cursor, [_get_moved_file_info(file_info, moved_paths) for file_info in file_infos])
 
 
 def _setup_shutdown_event():
@@ -67,26 +120,87 @@ def _parse_args():
                         help='Do not move the files, only register them')
     parser.add_argument('--no-db-report', action='store_false', dest='db_report',
                         help='Ignore old files from the database when doing the reporting')
-    parser.add_argument('files', nargs='+', help='The files to move and register')
+    parser.add_argument('--watch', action='append', metavar='DIR',
+                        help='Watch a directory and move and register files as soon as they are written')
+    parser.add_argument('--digest', action='append', dest='digests', default=[], choices=sorted(DIGESTS),
+                        help='An additional digest to compute and save for the files, besides ed2k')
+    parser.add_argument('--hash-only', action='store_true',
+                        help='Only hash the files and write them to the manifest given by --manifest')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='The manifest to write hashes to when using --hash-only')
+    parser.add_argument('--from-manifest', action='append', metavar='FILE',
+                        help='Register and move the files in a manifest instead of hashing them')
+    parser.add_argument('files', nargs='*', help='The files to move and register')
     # Note: this will never match anything and is only here to make the help text look good
     parser.add_argument('directory', help='The directory to move the files to', nargs='?')
 
     args = parser.parse_args()
 
+    if args.hash_only:
+        if not args.manifest:
+            parser.error('the --hash-only flag requires --manifest')
+        args.move = False
+    elif args.manifest:
+        parser.error('the --manifest flag can only be used together with --hash-only')
+
+    sources_flag = _get_sources_flag(args)
+    if sources_flag and args.hash_only:
+        parser.error(f'the --hash-only flag can not be used together with {sources_flag}')
+
+    if not args.files and not sources_flag:
+        parser.error('the following arguments are required: files')
+
     if args.move:
-        if len(args.files) < 2:
+        if len(args.files) < (1 if sources_flag else 2):
             print("A directory argument is required when not using the --no-move flag")
             sys.exit(1)
         elif not os.path.isdir(args.files[-1]):
             print(f"{args.files[-1]} is not a directory")
             sys.exit(1)
 
+    if sources_flag:
+        _check_no_source_files(args, sources_flag)
+    if args.watch:
+        _check_watch_args(args)
+
     args_files = args.files[:-1] if args.move else args.files
     args_directory = args.files[-1] if args.move else None
 
     return args_files, args_directory, args
 
 
+def _get_sources_flag(args):
+    sources_flags = [
+        flag for flag, value in [('--watch', args.watch), ('--from-manifest', args.from_manifest)] if value
+    ]
+    if len(sources_flags) > 1:
+        print(f"The {' and '.join(sources_flags)} flags can not be used together")
+        sys.exit(1)
+
+    return sources_flags[0] if sources_flags else None
+
+
+def _check_no_source_files(args, sources_flag):
+    if len(args.files) > (1 if args.move else 0):
+        print(f"Files can not be given together with the {sources_flag} flag, only a directory to move them to")
+        sys.exit(1)
+
+
+def _check_watch_args(args):
+    for directory in args.watch:
+        if not os.path.isdir(directory):
+            print(f"{directory} is not a directory")
+            sys.exit(1)
+
+
+def _check_that_watch_is_supported():
+    try:
+        watch.Inotify().close()
+    except OSError as e:
+        print(f"Failed to start watching: {e}")
+        sys.exit(1)
+
+
 def _read_config():
     xdg_config_home = os.getenv('XDG_CONFIG_HOME', '~/.config')
     config_path = os.path.expanduser(os.path.join(xdg_config_home, 'amv/config'))
@@ -110,6 +224,51 @@ def _read_config():
     }
 
 
+def _write_manifest(shutdown_event, args, files):
+    # The manifest may be written to one of the directories that are hashed
+    files = [file_name for file_name in files if os.path.abspath(file_name) != os.path.abspath(args.manifest)]
+    file_info_queue = Queue()
+    thread = _start_worker_thread(shutdown_event, args.watched, args.external, args.digests, file_info_queue, files)
+    with open(args.manifest, 'w', encoding='utf-8') as manifest_file:
+        for file_info in iter(file_info_queue.get, None):
+            manifest.write_entry(manifest_file, args.manifest, file_info)
+    thread.join()
+
+
+def _read_manifests(args):
+    watched_time = time.time()
+    file_infos = []
+    relative_paths = {}
+    for manifest_path in args.from_manifest:
+        try:
+            entries = manifest.read_manifest(manifest_path)
+        except (IOError, ManifestException) as e:
+            print(f"Failed to read manifest {manifest_path}: {e}")
+            sys.exit(1)
+
+        for entry in entries:
+            if not manifest.matches_local_file(entry):
+                print(f"Skipping {entry['path']} since it does not match the local file")
+                continue
+
+            file_infos.append({
+                'id': None,
+                'view_date': watched_time,
+                'internal': not args.external,
+                'watched': args.watched,
+                'path': entry['path'],
+                'size': entry['size'],
+                'ed2k': entry['ed2k'],
+                'crc32': None,
+                'md5': None,
+                'sha1': None,
+                **file_identity.get_identity(entry['path'])
+            })
+            relative_paths[entry['path']] = entry['relative_path']
+
+    return file_infos, relative_paths
+
+
 def _get_paths_to_register(files):
     files_to_register = []
     for file_ in files:
@@ -126,17 +285,62 @@ def _remove_duplicates(items):
     return list(OrderedDict.fromkeys(items))
 
 
-def _start_worker_thread(shutdown_event, watched, external, file_info_queue, files):
+# pylint: disable=too-many-arguments
+def _start_worker_thread(shutdown_event, watched, external, digest_names, file_info_queue, files):
     thread = Thread(
         target=_process_files,
-        args=(time.time(), watched, not external, shutdown_event, file_info_queue, files))
+        args=(time.time(), watched, not external, digest_names, shutdown_event, file_info_queue, files))
     thread.start()
 
     return thread
 
 
 # pylint: disable=too-many-arguments
-def _process_files(watched_time, watched, internal, shutdown_event, file_info_queue, files):
+def _start_watch_thread(shutdown_event, watched, external, digest_names, file_info_queue, directories, destination):
+    thread = Thread(
+        target=_process_watched_files,
+        args=(watched, not external, digest_names, shutdown_event, file_info_queue, directories, destination))
+    thread.start()
+
+    return thread
+
+
+def _create_file_info(watched_time, watched, internal, digest_names, file_name):
+    crc32_tag = crc32_tag_of_path(file_name)
+    if crc32_tag:
+        # The CRC32 is cheap to compute while the file is read anyway
+        digest_names = set(digest_names) | {'crc32'}
+
+    digests = digests_of_path(file_name, digest_names)
+    if crc32_tag and digests['crc32'] != crc32_tag:
+        print(f"Warning: CRC32 of {os.path.basename(file_name)} is {digests['crc32'].upper()}, "
+              f"but the file name says {crc32_tag.upper()}")
+
+    file_info = {
+        'id': None,
+        'view_date': watched_time,
+        'internal': internal,
+        'watched': watched,
+        # Absolute, since the path is checked by later runs in other working directories
+        'path': os.path.abspath(file_name),
+        'size': os.path.getsize(file_name),
+        'ed2k': digests['ed2k'],
+        'crc32': digests.get('crc32'),
+        'md5': digests.get('md5'),
+        'sha1': digests.get('sha1'),
+        **file_identity.get_identity(file_name)
+    }
+
+    if digests.keys() - {'ed2k'}:
+        # This runs in a worker thread, which can't use the connection of the main thread
+        with database.open_database() as cursor:
+            database.add_file_digests(cursor, [file_info])
+
+    return file_info
+
+
+# pylint: disable=too-many-arguments
+def _process_files(watched_time, watched, internal, digest_names, shutdown_event, file_info_queue, files):
     try:
         for file_name in files:
             if shutdown_event.is_set():
@@ -144,15 +348,7 @@ def _process_files(watched_time, watched, internal, shutdown_event, file_info_qu
 
             print(f"Processing file {os.path.basename(file_name)}")
             try:
-                file_info_queue.put({
-                    'id': None,
-                    'view_date': watched_time,
-                    'internal': internal,
-                    'watched': watched,
-                    'path': file_name,
-                    'size': os.path.getsize(file_name),
-                    'ed2k': ed2k_of_path(file_name)
-                })
+                file_info_queue.put(_create_file_info(watched_time, watched, internal, digest_names, file_name))
             except IOError as e:
                 print(f"Failed to process {file_name}: {e}")
 
@@ -162,14 +358,239 @@ def _process_files(watched_time, watched, internal, shutdown_event, file_info_qu
         shutdown_event.set()
 
 
-def _add_unregistered_files(file_info_queue, unregistered_file_infos):
-    for file_info in unregistered_file_infos:
+# pylint: disable=too-many-arguments
+def _process_watched_files(watched, internal, digest_names, shutdown_event, file_info_queue, directories,
+                           destination):
+    try:
+        for file_name in watch.watch_directories(directories, shutdown_event):
+            print(f"Processing file {os.path.basename(file_name)}")
+            try:
+                file_info = _create_file_info(time.time(), watched, internal, digest_names, file_name)
+            except IOError as e:
+                print(f"Failed to process {file_name}: {e}")
+                continue
+
+            if destination:
+                print(f"Moving {os.path.basename(file_name)} to {destination}")
+                try:
+                    file_info['path'] = os.path.abspath(shutil.move(file_name, destination))
+                    file_info.update(file_identity.get_identity(file_info['path']))
+                except (shutil.Error, FileNotFoundError) as e:
+                    print(f"Failed to move {file_name}: {e}")
+            file_info_queue.put(file_info)
+    except Exception as exception:  # pylint: disable=broad-except
+        print(f"Received exception {exception} while watching files")
+        shutdown_event.set()
+    finally:
+        file_info_queue.put(None)
+
+
+# pylint: disable=too-many-arguments
+def _register_file_infos(shutdown_event, args, config, cursor, session_lock, file_info_queue):
+    def is_in_mylist(file_info):
+        return database.is_in_mylist(cursor, file_info['ed2k'], file_info['size'])
+
+    if not args.watch:
+        # Files in the imported mylist are left out first, so that no session is opened just for them
+        file_infos = _remove_files_in_mylist(cursor, file_info_queue)
+        if not file_infos:
+            return []
+        file_info_queue = Queue()
+        _add_file_infos(file_info_queue, file_infos + [None])
+
+    file_infos_not_found = []
+
+    def on_file_not_found(file_info):
+        file_infos_not_found.append(file_info)
+        if file_info['id'] is None:
+            print(f"Adding {file_info['path']} to database")
+            database.add_unregistered_files(cursor, [file_info])
+
+    rate_limit_state = session_lock.read_rate_limit_state()
+    with UdpClient(shutdown_event, args.verbose, config, file_info_queue, is_in_mylist, rate_limit_state,
+                   on_file_not_found if args.watch else None) as client:
+        file_infos_not_found += client.register_file_infos()
+    session_lock.write_rate_limit_state(client.get_rate_limit_state())
+
+    return file_infos_not_found
+
+
+def _remove_files_in_mylist(cursor, file_info_queue):
+    file_infos = []
+    for file_info in iter(file_info_queue.get, None):
+        if database.is_in_mylist(cursor, file_info['ed2k'], file_info['size']):
+            print(f"File {file_info['path']} already registered according to the imported mylist")
+        else:
+            file_infos.append(file_info)
+
+    return file_infos
+
+
+# pylint: disable=too-many-arguments
+def _register_own_file_infos(shutdown_event, args, config, cursor, session_lock, file_info_queue):
+    if not args.watch:
+        return _register_file_infos(shutdown_event, args, config, cursor, session_lock, file_info_queue)
+
+    # Watching never finishes on its own, so files handed over by other processes are received meanwhile
+    stop_event = Event()
+    thread = _start_hand_over_thread(stop_event, file_info_queue)
+    try:
+        return _register_file_infos(shutdown_event, args, config, cursor, session_lock, file_info_queue)
+    finally:
+        stop_event.set()
+        thread.join()
+        database.add_queued_files(cursor, _get_remaining_file_infos(file_info_queue))
+
+
+def _get_remaining_file_infos(file_info_queue):
+    file_infos = []
+    while True:
+        try:
+            file_info = file_info_queue.get_nowait()
+        except Empty:
+            return file_infos
+        if file_info is not None:
+            file_infos.append(file_info)
+
+
+def _register_queued_file_infos(shutdown_event, args, config, cursor, session_lock):
+    file_infos_not_found = []
+    # The queue is checked again after releasing the session, since another process may have added
+    # files to it after failing to acquire the session, just before it was released
+    while not shutdown_event.is_set() and (
+            session_lock.acquired or (database.has_queued_files(cursor) and session_lock.try_acquire())):
+        queued_file_infos = database.pop_queued_files(cursor)
+        if queued_file_infos:
+            file_info_queue = Queue()
+            _add_file_infos(file_info_queue, queued_file_infos + [None])
+            file_infos_not_found += _register_file_infos(
+                shutdown_event, args, config, cursor, session_lock, file_info_queue)
+        session_lock.release()
+
+    return file_infos_not_found
+
+
+# pylint: disable=too-many-arguments
+def _hand_over_watched_file_infos(shutdown_event, args, config, cursor, session_lock, file_info_queue):
+    print("Another amv process is registering files, handing the files over to it")
+    while True:
+        # Watching may outlive the process holding the session, which then has to be taken over
+        if session_lock.try_acquire():
+            print("Taking over registering files from the other amv process")
+            return _register_own_file_infos(shutdown_event, args, config, cursor, session_lock, file_info_queue)
+
+        try:
+            file_info = file_info_queue.get(timeout=HAND_OVER_POLL_INTERVAL)
+        except Empty:
+            continue
+        if file_info is None:
+            return []
+        database.add_queued_files(cursor, [file_info])
+
+
+def _start_hand_over_thread(stop_event, file_info_queue):
+    thread = Thread(target=_receive_handed_over_files, args=(stop_event, file_info_queue))
+    thread.start()
+
+    return thread
+
+
+def _receive_handed_over_files(stop_event, file_info_queue):
+    # The thread can't use the connection of the main thread, so it keeps its own
+    with database.open_database() as cursor:
+        while not stop_event.wait(HAND_OVER_POLL_INTERVAL):
+            # Checking first avoids taking the write lock when nothing has been handed over
+            if database.has_queued_files(cursor):
+                _add_file_infos(file_info_queue, database.pop_queued_files(cursor))
+
+
+def _add_file_infos(file_info_queue, file_infos):
+    for file_info in file_infos:
         file_info_queue.put(file_info)
 
 
-def _add_unregistered_files_to_db(cursor, file_infos_from_database, file_infos_not_found):
+def _prune_stale_files(cursor, file_infos, files):
+    stale_file_infos = [file_info for file_info in file_infos if file_identity.is_stale(file_info)]
+    # Stale files may have been renamed to one of the files of this run, and are then kept at the new path
+    relocated_file_infos = _relocate_file_infos(stale_file_infos, files)
+    relocated_ids = [file_info['id'] for file_info in relocated_file_infos]
+    # Externally stored files may only be missing because their storage isn't mounted
+    ids_to_remove = [
+        file_info['id'] for file_info in stale_file_infos
+        if file_info['internal'] and file_info['id'] not in relocated_ids
+    ]
+    if ids_to_remove:
+        print("Removing files that no longer exist from the database")
+        database.remove_files(cursor, ids_to_remove)
+
+    changed_file_infos = [
+        {**file_info, **file_identity.get_identity(file_info['path'])}
+        for file_info in file_infos
+        if file_info not in stale_file_infos and file_identity.has_changed(file_info)
+    ]
+    if changed_file_infos or relocated_file_infos:
+        database.update_identities(cursor, changed_file_infos + relocated_file_infos)
+
+    return [file_info for file_info in file_infos if file_info not in stale_file_infos] + relocated_file_infos
+
+
+def _relocate_file_infos(file_infos, files):
+    if not file_infos:
+        return []
+
+    paths_by_identity = {}
+    for file_name in files:
+        identity = file_identity.get_identity(file_name)
+        if identity['inode'] is not None:
+            paths_by_identity[(identity['dev'], identity['inode'], identity['mtime'])] = os.path.abspath(file_name)
+
+    relocated_file_infos = []
+    for file_info in file_infos:
+        path = paths_by_identity.get((file_info['dev'], file_info['inode'], file_info['mtime']))
+        if path is not None:
+            print(f"Found {file_info['path']} at {path}")
+            relocated_file_infos.append({**file_info, 'path': path})
+
+    return relocated_file_infos
+
+
+def _remove_files_in_database(files, file_infos_from_database):
+    paths = {file_info['path'] for file_info in file_infos_from_database}
+    return [file_name for file_name in files if os.path.abspath(file_name) not in paths]
+
+
+def _get_moved_file_info(file_info, moved_paths):
+    for source, destination in moved_paths.items():
+        if file_info['path'] == source or file_info['path'].startswith(source + os.sep):
+            path = os.path.abspath(destination + file_info['path'][len(source):])
+            return {**file_info, 'path': path, **file_identity.get_identity(path)}
+
+    return file_info
+
+
+def _update_database(cursor, args, file_infos_from_database, file_infos_not_found, moved_paths):
+    # Watch mode adds the files that weren't found as soon as that is known
+    if not args.watch:
+        _add_unregistered_files_to_db(cursor, file_infos_from_database, file_infos_not_found, moved_paths)
+    _update_moved_files_in_db(cursor, file_infos_from_database, file_infos_not_found, moved_paths)
+    _remove_registered_files_from_db(cursor, file_infos_from_database, file_infos_not_found)
+
+
+def _update_moved_files_in_db(cursor, file_infos_from_database, file_infos_not_found, moved_paths):
+    # Files from the database may have been moved by this run, when they were also given as sources
+    moved_file_infos = [
+        _get_moved_file_info(file_info, moved_paths)
+        for file_info in file_infos_not_found if file_info in file_infos_from_database
+    ]
+    moved_file_infos = [file_info for file_info in moved_file_infos if file_info not in file_infos_from_database]
+    if moved_file_infos:
+        database.update_identities(cursor, moved_file_infos)
+
+
+def _add_unregistered_files_to_db(cursor, file_infos_from_database, file_infos_not_found, moved_paths):
     new_file_infos_to_register = [
-        file_info for file_info in file_infos_not_found if file_info not in file_infos_from_database
+        _get_moved_file_info(file_info, moved_paths)
+        for file_info in file_infos_not_found if file_info not in file_infos_from_database
     ]
 
     if new_file_infos_to_register:
@@ -195,13 +616,48 @@ def _remove_registered_files_from_db(cursor, file_infos_from_database, file_info
         )
 
 
+def _move_sources(args, files_and_dirs, relative_paths, directory):
+    if not args.move:
+        return {}
+    if args.from_manifest:
+        return _move_manifest_files(relative_paths, directory)
+    return _move_files(files_and_dirs, directory)
+
+
+def _move_manifest_files(relative_paths, directory):
+    moved_paths = {}
+    for file_name, relative_path in relative_paths.items():
+        # The files keep the directory structure they have in the manifest, unless they are outside of it
+        if os.path.isabs(relative_path) or relative_path.startswith(os.pardir + os.sep):
+            relative_path = os.path.basename(relative_path)
+        destination = os.path.join(directory, relative_path)
+        print(f"Moving {file_name} to {destination}")
+        try:
+            if os.path.exists(destination):
+                raise FileExistsError(f"Destination path '{destination}' already exists")
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(file_name, destination)
+        except (shutil.Error, OSError) as e:
+            print(f"Failed to move {file_name}: {e}")
+        else:
+            moved_paths[os.path.abspath(file_name)] = os.path.abspath(destination)
+
+    return moved_paths
+
+
 def _move_files(files, directory):
+    moved_paths = {}
     for file_name in files:
         print(f"Moving {os.path.basename(file_name)} to {directory}")
         try:
             shutil.move(file_name, directory)
         except (shutil.Error, FileNotFoundError) as e:
             print(f"Failed to move {file_name}: {e}")
+        else:
+            moved_paths[os.path.abspath(file_name)] = os.path.abspath(
+                os.path.join(directory, os.path.basename(file_name.rstrip(os.sep))))
+
+    return moved_paths
 
 
 if __name__ == '__main__':
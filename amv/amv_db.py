@@ -1,7 +1,12 @@
 import argparse
+import os
+import sys
 from datetime import datetime
 
 from . import database
+from . import file_identity
+from . import mylist
+from .exceptions import MylistExportException
 
 
 def main():
@@ -12,6 +17,10 @@ def main():
         _handle_remove(args.ids)
     elif args.action == 'clear':
         _handle_clear()
+    elif args.action == 'prune':
+        _handle_prune(args.external)
+    elif args.action == 'import-mylist':
+        _handle_import_mylist(args.file)
 
 
 def _parse_args():
@@ -21,6 +30,11 @@ def _parse_args():
     subparsers.add_parser('clear')
     remove_parser = subparsers.add_parser('remove')
     remove_parser.add_argument('ids', nargs='+', type=int)
+    prune_parser = subparsers.add_parser('prune')
+    prune_parser.add_argument('--external', action='store_true',
+                              help='Also remove externally stored files, which may only be missing since not mounted')
+    import_mylist_parser = subparsers.add_parser('import-mylist')
+    import_mylist_parser.add_argument('file', help='A mylist export from AniDB with ed2k hashes and sizes')
 
     return parser.parse_args()
 
@@ -78,5 +92,39 @@ def _handle_remove(ids):
         database.remove_files(cursor, ids)
 
 
+def _handle_prune(external):
+    with database.open_database() as cursor:
+        file_infos = database.get_unregistered_files(cursor)
+        stale_file_infos = [
+            file_info for file_info in file_infos
+            if (file_info['internal'] or external) and file_identity.is_stale(file_info)
+        ]
+        if stale_file_infos:
+            print("Removing files that no longer exist:")
+            _print_list_header()
+            for file_info in stale_file_infos:
+                print_list_line(file_info)
+            database.remove_files(cursor, [file_info['id'] for file_info in stale_file_infos])
+
+        relative_file_infos = [file_info for file_info in file_infos if not os.path.isabs(file_info['path'])]
+        if relative_file_infos:
+            print("Files with relative paths can not be checked and were kept:")
+            _print_list_header()
+            for file_info in relative_file_infos:
+                print_list_line(file_info)
+
+
+def _handle_import_mylist(file_name):
+    try:
+        entries = mylist.read_mylist_export(file_name)
+    except (IOError, MylistExportException) as e:
+        print(f"Failed to read mylist export {file_name}: {e}")
+        sys.exit(1)
+
+    with database.open_database() as cursor:
+        database.add_mylist_files(cursor, entries)
+    print(f"Imported {len(entries)} files from {file_name}")
+
+
 if __name__ == '__main__':
     main()
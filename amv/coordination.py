@@ -0,0 +1,49 @@
+import fcntl
+import json
+import os
+
+LOCK_PATH = '~/.amv.lock'
+
+
+# Only the process holding the lock binds the local port and talks to AniDB. The lock file also
+# stores the rate limit state, so that a process taking over the session continues from it.
+class SessionLock:
+    def __init__(self, lock_path=None):
+        self._lock_path = os.path.expanduser(lock_path or LOCK_PATH)
+        self._file = None
+        self.acquired = False
+
+    def __enter__(self):
+        # pylint: disable=consider-using-with
+        self._file = open(self._lock_path, 'a+', encoding='utf-8')
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+        self._file.close()
+
+    def try_acquire(self):
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.acquired = True
+        return True
+
+    def release(self):
+        if self.acquired:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self.acquired = False
+
+    def read_rate_limit_state(self):
+        self._file.seek(0)
+        try:
+            return json.loads(self._file.read())
+        except ValueError:
+            return None
+
+    def write_rate_limit_state(self, state):
+        self._file.seek(0)
+        self._file.truncate()
+        json.dump(state, self._file)
+        self._file.flush()
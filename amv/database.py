@@ -1,17 +1,35 @@
+import json
 import os
 import sqlite3
 from contextlib import contextmanager
 
+# Columns added after the first release, which older databases lack
+ADDED_COLUMNS = [
+    ('crc32', 'varchar(8)'),
+    ('md5', 'varchar(32)'),
+    ('sha1', 'varchar(40)'),
+    ('dev', 'integer'),
+    ('inode', 'integer'),
+    ('mtime', 'real'),
+]
+
+# How long to wait for other amv processes to finish writing to the database
+BUSY_TIMEOUT = 60
+
+COLUMNS = ['view_date', 'watched', 'internal', 'ed2k', 'size', 'path'] + [name for name, _ in ADDED_COLUMNS]
+
 
 @contextmanager
 def open_database(database_path=None):
     database_path = database_path or os.path.expanduser('~/.amv.sqlite3')
     connection = None
     try:
-        connection = sqlite3.connect(database_path)
+        connection = sqlite3.connect(database_path, timeout=BUSY_TIMEOUT)
         # Workaround for https://github.com/ghaering/pysqlite/issues/109
         connection.isolation_level = None
         cursor = connection.cursor()
+        # Lets other processes read while one is writing
+        cursor.execute('pragma journal_mode=wal')
         cursor.execute('create table if not exists unregistered_files ('
                        'view_date datetime,'
                        'watched boolean,'
@@ -20,6 +38,22 @@ def open_database(database_path=None):
                        'size integer,'
                        'path text'
                        ')')
+        _add_missing_columns(cursor)
+        cursor.execute('create table if not exists mylist_files ('
+                       'ed2k varchar(32),'
+                       'size integer,'
+                       'primary key (ed2k, size)'
+                       ')')
+        cursor.execute('create table if not exists queued_files (file_info text)')
+        cursor.execute('create table if not exists file_digests ('
+                       'ed2k varchar(32),'
+                       'size integer,'
+                       'path text,'
+                       'crc32 varchar(8),'
+                       'md5 varchar(32),'
+                       'sha1 varchar(40),'
+                       'primary key (ed2k, size)'
+                       ')')
         yield cursor
     finally:
         if connection:
@@ -27,6 +61,13 @@ def open_database(database_path=None):
             connection.close()
 
 
+def _add_missing_columns(cursor):
+    existing_columns = [row[1] for row in cursor.execute('pragma table_info(unregistered_files)')]
+    for name, column_type in ADDED_COLUMNS:
+        if name not in existing_columns:
+            cursor.execute(f'alter table unregistered_files add column {name} {column_type}')
+
+
 def clear(cursor):
     cursor.execute('delete from unregistered_files')
     cursor.execute('vacuum')
@@ -37,7 +78,7 @@ def remove_files(cursor, ids):
 
 
 def get_unregistered_files(cursor):
-    results = cursor.execute('select rowid, * from unregistered_files')
+    results = cursor.execute(f'select rowid, {", ".join(COLUMNS)} from unregistered_files')
     return [{
         'id': result[0],
         'view_date': result[1],
@@ -46,14 +87,104 @@ def get_unregistered_files(cursor):
         'ed2k': result[4],
         'size': result[5],
         'path': result[6],
+        'crc32': result[7],
+        'md5': result[8],
+        'sha1': result[9],
+        'dev': result[10],
+        'inode': result[11],
+        'mtime': result[12],
     } for result in results]
 
 
+def _update_moved_file(cursor, file_info):
+    if file_info.get('inode') is None:
+        return False
+
+    result = cursor.execute(
+        'update unregistered_files set path=? where dev=? and inode=? and mtime=?',
+        (file_info['path'], file_info['dev'], file_info['inode'], file_info['mtime']))
+    return result.rowcount > 0
+
+
+def update_identities(cursor, file_infos):
+    # The path is updated as well, since files may be found again after being renamed or moved
+    cursor.executemany('update unregistered_files set path=?, dev=?, inode=?, mtime=? where rowid=?', ((
+        file_info['path'],
+        file_info['dev'],
+        file_info['inode'],
+        file_info['mtime'],
+        file_info['id']) for file_info in file_infos))
+
+
 def add_unregistered_files(cursor, file_infos):
-    cursor.executemany('insert into unregistered_files values (?, ?, ?, ?, ? ,?)', ((
-        file_info['view_date'],
-        file_info['watched'],
-        file_info['internal'],
-        file_info['ed2k'],
-        file_info['size'],
-        file_info['path']) for file_info in file_infos))
+    # Files that are already in the database under another path have been renamed or moved since
+    new_file_infos = [file_info for file_info in file_infos if not _update_moved_file(cursor, file_info)]
+    cursor.executemany(
+        f'insert into unregistered_files ({", ".join(COLUMNS)}) values ({", ".join("?" * len(COLUMNS))})', ((
+            file_info['view_date'],
+            file_info['watched'],
+            file_info['internal'],
+            file_info['ed2k'],
+            file_info['size'],
+            file_info['path'],
+            file_info.get('crc32'),
+            file_info.get('md5'),
+            file_info.get('sha1'),
+            file_info.get('dev'),
+            file_info.get('inode'),
+            file_info.get('mtime')) for file_info in new_file_infos))
+
+
+def add_file_digests(cursor, file_infos):
+    # Digests from earlier runs are kept when the same file is hashed again with fewer digests
+    cursor.executemany(
+        'insert into file_digests values (?, ?, ?, ?, ?, ?) on conflict (ed2k, size) do update set '
+        'path=excluded.path,'
+        'crc32=coalesce(excluded.crc32, crc32),'
+        'md5=coalesce(excluded.md5, md5),'
+        'sha1=coalesce(excluded.sha1, sha1)', ((
+            file_info['ed2k'],
+            file_info['size'],
+            file_info['path'],
+            file_info['crc32'],
+            file_info['md5'],
+            file_info['sha1']) for file_info in file_infos))
+
+
+def get_file_digests(cursor):
+    results = cursor.execute('select * from file_digests')
+    return [{
+        'ed2k': result[0],
+        'size': result[1],
+        'path': result[2],
+        'crc32': result[3],
+        'md5': result[4],
+        'sha1': result[5],
+    } for result in results]
+
+
+def add_mylist_files(cursor, entries):
+    cursor.execute('begin')
+    cursor.executemany('insert or ignore into mylist_files values (?, ?)', entries)
+    cursor.execute('commit')
+
+
+def is_in_mylist(cursor, ed2k, size):
+    result = cursor.execute('select 1 from mylist_files where ed2k=? and size=?', (ed2k.lower(), size))
+    return result.fetchone() is not None
+
+
+def add_queued_files(cursor, file_infos):
+    cursor.executemany('insert into queued_files values (?)', ((json.dumps(file_info),) for file_info in file_infos))
+
+
+def pop_queued_files(cursor):
+    cursor.execute('begin immediate')
+    results = cursor.execute('select rowid, file_info from queued_files').fetchall()
+    cursor.executemany('delete from queued_files where rowid=?', ((result[0],) for result in results))
+    cursor.execute('commit')
+    return [json.loads(result[1]) for result in results]
+
+
+def has_queued_files(cursor):
+    return cursor.execute('select 1 from queued_files limit 1').fetchone() is not None
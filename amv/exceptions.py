@@ -1,2 +1,10 @@
 class AnidbProtocolException(Exception):
     pass
+
+
+class ManifestException(Exception):
+    pass
+
+
+class MylistExportException(Exception):
+    pass
@@ -0,0 +1,23 @@
+import os
+
+
+def get_identity(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {'dev': None, 'inode': None, 'mtime': None}
+    return {'dev': stat.st_dev, 'inode': stat.st_ino, 'mtime': stat.st_mtime}
+
+
+def is_stale(file_info):
+    # Relative paths were added by older versions and depend on the working directory at the time
+    if not os.path.isabs(file_info['path']):
+        return False
+    return not os.path.exists(file_info['path'])
+
+
+def has_changed(file_info):
+    identity = get_identity(file_info['path'])
+    if identity['inode'] is None or file_info.get('inode') is None:
+        return False
+    return any(file_info[key] != value for key, value in identity.items())
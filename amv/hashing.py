@@ -1,23 +1,71 @@
 import hashlib
 import os
+import re
+import zlib
+from datetime import datetime
+
+ED2K_BLOCK_SIZE = 9500 * 1024
+
+CRC32_TAG_PATTERN = re.compile(r'\[([0-9A-Fa-f]{8})\]|\(([0-9A-Fa-f]{8})\)')
+
+
+class _Crc32:
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self):
+        return f'{self._value:08x}'
+
+
+DIGESTS = {
+    'crc32': _Crc32,
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+}
 
 
 def _md4_of_block(block):
     return hashlib.new('md4', block)
 
 
-def ed2k_of_path(path):
-    block_size = 9500 * 1024
+def digests_of_path(path, digest_names=()):
+    hashes = {name: DIGESTS[name]() for name in digest_names}
     digests = []
 
     with open(path, 'rb') as file_:
-        if os.path.getsize(path) < block_size:
-            digests.append(file_.read())
-        else:
-            while True:
-                block = file_.read(block_size)
-                digest = _md4_of_block(block).digest()
-                digests.append(digest)
-                if len(block) < block_size:
-                    break
-    return _md4_of_block(b''.join(digests)).hexdigest()
+        single_block = os.path.getsize(path) < ED2K_BLOCK_SIZE
+        while True:
+            block = file_.read(ED2K_BLOCK_SIZE)
+            for hash_ in hashes.values():
+                hash_.update(block)
+            digests.append(block if single_block else _md4_of_block(block).digest())
+            if len(block) < ED2K_BLOCK_SIZE:
+                break
+
+    return {
+        'ed2k': _md4_of_block(b''.join(digests)).hexdigest(),
+        **{name: hash_.hexdigest() for name, hash_ in hashes.items()}
+    }
+
+
+def ed2k_of_path(path):
+    return digests_of_path(path)['ed2k']
+
+
+def _is_date(tag):
+    try:
+        datetime.strptime(tag, '%Y%m%d')
+    except ValueError:
+        return False
+    return True
+
+
+def crc32_tag_of_path(path):
+    # Release groups put the tag last, after tags such as [1080p]. Dates such as [20240101] also
+    # look like CRC32 tags, but would give false mismatches.
+    tags = [match.group(1) or match.group(2) for match in CRC32_TAG_PATTERN.finditer(os.path.basename(path))]
+    tags = [tag for tag in tags if not _is_date(tag)]
+    return tags[-1].lower() if tags else None
@@ -0,0 +1,55 @@
+import os
+
+from .exceptions import ManifestException
+
+FIELD_SEPARATOR = '\t'
+
+
+def _mtime_of_path(path):
+    # Whole seconds, since the manifest may be compared against a different filesystem
+    return int(os.path.getmtime(path))
+
+
+def _manifest_directory(manifest_path):
+    return os.path.dirname(os.path.abspath(manifest_path))
+
+
+# Paths are relative to the manifest, since the hosts may mount the files at different paths
+def write_entry(file_, manifest_path, file_info):
+    file_.write(FIELD_SEPARATOR.join([
+        str(file_info['size']),
+        file_info['ed2k'],
+        str(_mtime_of_path(file_info['path'])),
+        os.path.relpath(file_info['path'], _manifest_directory(manifest_path))
+    ]) + '\n')
+
+
+def read_manifest(manifest_path):
+    entries = []
+    with open(manifest_path, encoding='utf-8') as file_:
+        for line_number, line in enumerate(file_, start=1):
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+
+            parts = line.split(FIELD_SEPARATOR, maxsplit=3)
+            try:
+                size, ed2k, mtime, path = parts
+                entries.append({
+                    'size': int(size),
+                    'ed2k': ed2k,
+                    'mtime': int(mtime),
+                    'path': os.path.join(_manifest_directory(manifest_path), path),
+                    'relative_path': path
+                })
+            except ValueError as e:
+                raise ManifestException(f'Failed to parse line {line_number} of {manifest_path}: {e}') from e
+
+    return entries
+
+
+def matches_local_file(entry):
+    try:
+        return os.path.getsize(entry['path']) == entry['size'] and _mtime_of_path(entry['path']) == entry['mtime']
+    except OSError:
+        return False
@@ -0,0 +1,47 @@
+import csv
+import re
+
+from .exceptions import MylistExportException
+
+ED2K_LINK_PATTERN = re.compile(r'ed2k://\|file\|[^|]*\|(\d+)\|([0-9A-Fa-f]{32})\|', re.IGNORECASE)
+ED2K_PATTERN = re.compile(r'[0-9A-Fa-f]{32}')
+CSV_DELIMITERS = [',', '\t', ';', '|']
+
+
+def _read_csv_entries(lines, delimiter):
+    reader = csv.DictReader(lines, delimiter=delimiter)
+    columns = {name.strip().lower(): name for name in reader.fieldnames}
+    entries = []
+    for line_number, row in enumerate(reader, start=2):
+        try:
+            ed2k = row[columns['ed2k']].strip()
+            size = int(row[columns['size']])
+        except (AttributeError, TypeError, ValueError) as e:
+            raise MylistExportException(f'Failed to parse line {line_number}: {e}') from e
+        if not ED2K_PATTERN.fullmatch(ed2k):
+            raise MylistExportException(f'Invalid ed2k hash "{ed2k}" on line {line_number}')
+        entries.append((ed2k.lower(), size))
+
+    return entries
+
+
+def _read_ed2k_link_entries(lines):
+    return [
+        (ed2k.lower(), int(size))
+        for line in lines
+        for size, ed2k in ED2K_LINK_PATTERN.findall(line)
+    ]
+
+
+def read_mylist_export(path):
+    # Exports with a header containing ed2k and size columns are read as CSV or TSV, otherwise all
+    # ed2k links in the export are used, which works with any export template that includes them
+    with open(path, encoding='utf-8') as file_:
+        lines = file_.read().splitlines()
+
+    for delimiter in CSV_DELIMITERS:
+        header = lines[0].split(delimiter) if lines else []
+        if {'ed2k', 'size'} <= {name.strip().lower() for name in header}:
+            return _read_csv_entries(lines, delimiter)
+
+    return _read_ed2k_link_entries(lines)
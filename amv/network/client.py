@@ -21,14 +21,22 @@ LARGE_DELAY = 4
 
 class UdpClient:
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, shutdown_event, verbose, config, file_info_queue):
+    # pylint: disable=too-many-arguments
+    def __init__(self, shutdown_event, verbose, config, file_info_queue, is_in_mylist=None, rate_limit_state=None,
+                 on_file_not_found=None):
         self._verbose = verbose
+        self._is_in_mylist = is_in_mylist
+        self._rate_limit_state = rate_limit_state
+        # When set, failures are handled per file since the session is long-lived, and files that
+        # weren't found are passed to it right away instead of being returned at the end
+        self._on_file_not_found = on_file_not_found
         self._config = config
         self._shutdown_event = shutdown_event
         self._file_info_queue = file_info_queue
         self._socket = None
         self._nr_free_packets = MAX_OUTSTANDING_PACKAGES
         self._start_time = None
+        self._last_send_time = None
         self._session_id = None
 
     def register_file_infos(self):
@@ -37,26 +45,79 @@ class UdpClient:
             file_info = self._file_info_queue.get()
             if file_info is None or self._shutdown_event.is_set():
                 break
-            if not self._register_file(file_info):
+            if self._is_in_mylist and self._is_in_mylist(file_info):
+                print(f'File {file_info["path"]} already registered according to the imported mylist')
+                continue
+            if self._on_file_not_found:
+                if not self._register_file_or_give_up(file_info):
+                    self._on_file_not_found(file_info)
+            elif not self._register_file(file_info):
                 no_such_file_infos.append(file_info)
 
         return no_such_file_infos
 
+    def _register_file_or_give_up(self, file_info):
+        try:
+            return self._register_file(file_info)
+        except (OSError, exceptions.AnidbProtocolException) as e:
+            print(f"Failed to register {file_info['path']}: {e}, logging in again")
+
+        try:
+            self._discard_pending_datagrams()
+            self._login()
+            return self._register_file(file_info)
+        except (OSError, exceptions.AnidbProtocolException) as e:
+            print(f"Failed to register {file_info['path']} again: {e}, it will be retried later")
+            return False
+
+    def _discard_pending_datagrams(self):
+        # Replies that arrived after timing out would otherwise be taken as replies to later messages
+        self._socket.setblocking(False)
+        try:
+            while True:
+                self._socket.recvfrom(MAX_DATAGRAM_SIZE)
+        except BlockingIOError:
+            pass
+        finally:
+            self._socket.settimeout(TIMEOUT)
+
     def _print_if_verbose_mode(self, *args):
         if self._verbose:
             print(*args)
 
     def __enter__(self):
         self._start_time = time.time()
+        self._restore_rate_limit_state()
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.bind((LOCAL_BIND_ADDRESS, self._config['local_port']))
         self._socket.settimeout(TIMEOUT)
         self._login()
         return self
 
-    def __exit__(self, *_):
-        self._shutdown_event.set()
-        self._logout()
+    def __exit__(self, exc_type, *_):
+        # The worker threads have already finished unless something went wrong
+        if exc_type:
+            self._shutdown_event.set()
+        try:
+            self._logout()
+        finally:
+            # The session may be reopened on the same port for files handed over by other processes
+            self._socket.close()
+
+    def _restore_rate_limit_state(self):
+        # The state is left by an earlier process and is only relevant if it sent packets recently
+        state = self._rate_limit_state
+        if state and time.time() - state['last_send_time'] < EXTENDED_PERIOD_OF_TIME:
+            self._nr_free_packets = state['nr_free_packets']
+            self._start_time = state['start_time']
+            self._last_send_time = state['last_send_time']
+
+    def get_rate_limit_state(self):
+        return {
+            'nr_free_packets': self._nr_free_packets,
+            'start_time': self._start_time,
+            'last_send_time': self._last_send_time or time.time(),
+        }
 
     def _get_delay_and_decrease_counter(self):
         if self._nr_free_packets > 0:
@@ -73,8 +134,12 @@ class UdpClient:
     def _send_with_delay(self, datagram):
         self._print_if_verbose_mode(f"Sending {datagram}")
         delay = self._get_delay_and_decrease_counter()
+        if self._last_send_time:
+            # Time that has already passed since the last packet, possibly sent by another process, counts
+            delay = max(0, delay - (time.time() - self._last_send_time))
         time.sleep(delay)
         self._socket.sendto(datagram, (ANIDB_HOST, ANIDB_PORT))
+        self._last_send_time = time.time()
 
     def _receive(self):
         datagram, _ = self._socket.recvfrom(MAX_DATAGRAM_SIZE)
@@ -102,7 +167,7 @@ class UdpClient:
         self._send_with_delay(messages.logout_message())
 
     # pylint: disable=inconsistent-return-statements
-    def _register_file(self, file_info):
+    def _register_file(self, file_info, retry_login=True):
         self._print_if_verbose_mode(f"Registering file {file_info['path']}")
         self._send_with_delay(messages.mylistadd_message(
             size=file_info['size'],
@@ -120,5 +185,10 @@ class UdpClient:
         if response['number'] == codes.MYLIST_ENTRY_ADDED:
             print(f'File {file_info["path"]} registered successfully')
             return True
+        if response['number'] in [codes.LOGIN_FIRST, codes.INVALID_SESSION] and retry_login:
+            # Sessions expire when idle for too long, which happens when watching directories
+            self._print_if_verbose_mode('Session expired, logging in again')
+            self._login()
+            return self._register_file(file_info, retry_login=False)
 
         self._raise_error(response)
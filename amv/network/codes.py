@@ -3,3 +3,5 @@ LOGIN_ACCEPTED_NEW_VERSION = 201
 NO_SUCH_FILE_CODE = 320
 FILE_ALREADY_IN_MYLIST = 310
 MYLIST_ENTRY_ADDED = 210
+LOGIN_FIRST = 501
+INVALID_SESSION = 506
@@ -0,0 +1,179 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+import weakref
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_BUFFER_SIZE = 64 * 1024
+
+POLL_INTERVAL = 1
+SETTLE_TIME = 5
+
+# Suffixes used by download clients for files that are still being downloaded
+PARTIAL_SUFFIXES = ('.part', '.!qB', '.crdownload', '.tmp')
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not supported on this platform')
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _raise_from_errno(path=None):
+    error_number = ctypes.get_errno()
+    raise OSError(error_number, os.strerror(error_number), path)
+
+
+class Inotify:
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            _raise_from_errno()
+        # Closes the file descriptor even if close is never called
+        self._finalizer = weakref.finalize(self, os.close, self._fd)
+        self._paths_by_wd = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._finalizer()
+
+    def add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            _raise_from_errno(directory)
+        self._paths_by_wd[wd] = directory
+
+    def add_watch_recursively(self, directory):
+        files = []
+        for root, _, files_in_dir in os.walk(directory):
+            try:
+                self.add_watch(root)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            files += [os.path.join(root, file_name) for file_name in files_in_dir]
+
+        return files
+
+    def read_events(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buffer = os.read(self._fd, READ_BUFFER_SIZE)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                print("Inotify event queue overflowed, some files may have been missed")
+                continue
+
+            directory = self._paths_by_wd.get(wd)
+            if mask & IN_IGNORED:
+                self._paths_by_wd.pop(wd, None)
+            elif directory is not None:
+                events.append((os.path.join(directory, name) if name else directory, mask))
+
+        return events
+
+
+def _is_partial(path):
+    return path.endswith(PARTIAL_SUFFIXES)
+
+
+def _stat_or_none(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _add_pending(pending, paths, settle_time):
+    for path in paths:
+        if not _is_partial(path):
+            pending[path] = (_stat_or_none(path), time.monotonic() + settle_time)
+
+
+def _pop_settled_files(pending, settle_time):
+    settled_files = []
+    now = time.monotonic()
+    for path, (previous_stat, deadline) in list(pending.items()):
+        if deadline > now:
+            continue
+
+        current_stat = _stat_or_none(path)
+        if current_stat is None:
+            del pending[path]
+        elif current_stat == previous_stat:
+            del pending[path]
+            settled_files.append(path)
+        else:
+            pending[path] = (current_stat, now + settle_time)
+
+    return settled_files
+
+
+def _handle_event(inotify, path, mask):
+    if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            return inotify.add_watch_recursively(path)
+        return []
+    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        return [path]
+    return []
+
+
+def _watch(inotify, shutdown_event, settle_time):
+    pending = {}
+    try:
+        while not shutdown_event.is_set():
+            # The timeout is only there so that the shutdown event is noticed
+            for path, mask in inotify.read_events(POLL_INTERVAL):
+                _add_pending(pending, _handle_event(inotify, path, mask), settle_time)
+
+            yield from _pop_settled_files(pending, settle_time)
+    finally:
+        inotify.close()
+
+
+def watch_directories(directories, shutdown_event, settle_time=SETTLE_TIME):
+    # The watches are added before returning so that no files written in the meantime are missed
+    inotify = Inotify()
+    try:
+        for directory in directories:
+            inotify.add_watch_recursively(directory)
+    except OSError:
+        inotify.close()
+        raise
+
+    return _watch(inotify, shutdown_event, settle_time)
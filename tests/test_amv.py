@@ -1,9 +1,24 @@
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+from queue import Empty, Queue
+from threading import Event
 from unittest import TestCase
-from unittest.mock import call, patch, ANY
+from unittest.mock import call, patch, ANY, MagicMock
 
 from amv import amv
 from amv import amv_db
+from amv import coordination
 from amv import database
+from amv import exceptions
+from amv import file_identity
+from amv import hashing
+from amv import manifest
+from amv import mylist
+from amv import watch
+from amv.network.client import UdpClient
 
 
 def _create_file_info(path, id_=None):
@@ -12,28 +27,45 @@ def _create_file_info(path, id_=None):
         'view_date': 1532983833.2112887,
         'internal': True,
         'watched': True,
-        'path': path,
+        'path': os.path.abspath(path),
         'size': 1337,
-        'ed2k': '1' * 32
+        'ed2k': '1' * 32,
+        'crc32': None,
+        'md5': None,
+        'sha1': None,
+        'dev': None,
+        'inode': None,
+        'mtime': None
     }
 
 
 class AmvTest(TestCase):
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
     def setUp(self):
         self.client_mock = patch('amv.amv.UdpClient').start()
         self.move_mock = patch('shutil.move').start()
         self.remove_files_mock = patch('amv.database.remove_files').start()
         self.add_unregistered_files_mock = patch('amv.database.add_unregistered_files').start()
         self.get_unregistered_files_mock = patch('amv.database.get_unregistered_files', return_value=[]).start()
+        self.pop_queued_files_mock = patch('amv.database.pop_queued_files', return_value=[]).start()
+        patch('amv.database.has_queued_files', return_value=False).start()
+        self.add_queued_files_mock = patch('amv.database.add_queued_files').start()
+        self.is_stale_mock = patch('amv.file_identity.is_stale', return_value=False).start()
+        self.is_in_mylist_mock = patch('amv.database.is_in_mylist', return_value=False).start()
+
+        lock_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_directory)
+        patch('amv.coordination.LOCK_PATH', os.path.join(lock_directory, 'amv.lock')).start()
 
         patch('amv.database.open_database').start()
         patch('os.path.isdir', side_effect=self._mock_isdir).start()
         patch('os.walk', side_effect=self._mock_walk).start()
         patch('os.path.getsize', return_value=1337).start()
-        patch('amv.amv.ed2k_of_path', return_value='1' * 32).start()
+        self.digests_of_path_mock = patch('amv.amv.digests_of_path', return_value={'ed2k': '1' * 32}).start()
         patch('time.time', return_value=1532983833.2112887).start()
 
         self.client_mock.return_value.__enter__.return_value.register_file_infos.return_value = []
+        self.client_mock.return_value.__enter__.return_value.get_rate_limit_state.return_value = {}
 
         self.addCleanup(patch.stopall)
 
@@ -63,6 +95,7 @@ class AmvTest(TestCase):
     @patch('sys.argv', ['amv', 'dir1', 'dir2', 'dir1', 'dir3'])
     @patch('amv.amv.Queue')
     def test_source_are_directories(self, queue_mock):
+        queue_mock.return_value.get.return_value = None
         amv.main()
 
         queue_mock.return_value.put.assert_has_calls([
@@ -90,14 +123,15 @@ class AmvTest(TestCase):
         self.remove_files_mock.assert_not_called()
         self.add_unregistered_files_mock.assert_has_calls([call(
             ANY, [
-                _create_file_info('file1', id_=1),
-                _create_file_info('file2', id_=2),
+                _create_file_info('dir/file1', id_=1),
+                _create_file_info('dir/file2', id_=2),
             ]
         )])
 
     @patch('sys.argv', ['amv', '-n', 'file1', 'file2', 'dir1'])
     @patch('amv.amv.Queue')
     def test_no_files_moved(self, queue_mock):
+        queue_mock.return_value.get.return_value = None
         amv.main()
 
         queue_mock.return_value.put.assert_has_calls([
@@ -149,6 +183,354 @@ class AmvTest(TestCase):
             call('file3', 'dir')
         ])
 
+    @patch('sys.argv', ['amv', '--watch', 'dir1', 'file1', 'dir2'])
+    def test_watch_with_files(self):
+        with self.assertRaises(SystemExit):
+            amv.main()
+
+    @patch('sys.argv', ['amv', '--watch', 'dir1', 'dir2'])
+    @patch('amv.amv.Queue')
+    def test_watch_moves_files(self, queue_mock):
+        self.move_mock.return_value = 'dir2/file1'
+        queue_mock.return_value.get_nowait.side_effect = Empty
+        with patch('amv.watch.watch_directories', return_value=['dir1/file1']) as watch_mock:
+            amv.main()
+
+        watch_mock.assert_called_once_with(['dir1'], ANY)
+        self.move_mock.assert_has_calls([call('dir1/file1', 'dir2')])
+        queue_mock.return_value.put.assert_has_calls([
+            call(_create_file_info('dir2/file1')),
+            call(None),
+        ])
+
+    @patch('sys.argv', ['amv', '--from-manifest', 'hashes.tsv', 'dir'])
+    @patch('amv.amv.Queue')
+    def test_from_manifest(self, queue_mock):
+        queue_mock.return_value.get.return_value = None
+        entries = [
+            {'size': 1337, 'ed2k': '1' * 32, 'mtime': 1532983833, 'path': '/nas/show/file1',
+             'relative_path': 'show/file1'},
+            {'size': 1337, 'ed2k': '1' * 32, 'mtime': 1532983833, 'path': '/nas/file2', 'relative_path': 'file2'},
+        ]
+        with patch('amv.manifest.read_manifest', return_value=entries), \
+                patch('amv.manifest.matches_local_file', side_effect=lambda entry: entry['path'] != '/nas/file2'), \
+                patch('os.makedirs') as makedirs_mock:
+            amv.main()
+
+        queue_mock.return_value.put.assert_has_calls([
+            call(_create_file_info('/nas/show/file1')),
+            call(None),
+        ])
+        makedirs_mock.assert_called_once_with('dir/show', exist_ok=True)
+        self.move_mock.assert_has_calls([call('/nas/show/file1', 'dir/show/file1')])
+        self.assertEqual(self.move_mock.call_count, 1)
+
+    @patch('sys.argv', ['amv', '--hash-only', '--manifest', 'dir1/child_file2', 'dir1'])
+    def test_hash_only_skips_manifest(self):
+        with patch('builtins.open'), patch('amv.manifest.write_entry') as write_entry_mock:
+            amv.main()
+
+        self.digests_of_path_mock.assert_called_once_with('dir1/child_file1', ANY)
+        write_entry_mock.assert_called_once()
+
+    @patch('sys.argv', ['amv', '--hash-only', 'file1'])
+    def test_hash_only_without_manifest(self):
+        with self.assertRaises(SystemExit):
+            amv.main()
+
+    @patch('sys.argv', ['amv', '-n', '--digest', 'md5', '[Group] Show - 01 [1080p][ABCD1234].mkv'])
+    @patch('amv.amv.Queue')
+    def test_crc32_mismatch_warning(self, queue_mock):
+        queue_mock.return_value.get.return_value = None
+        self.digests_of_path_mock.return_value = {'ed2k': '1' * 32, 'crc32': 'deadbeef', 'md5': '2' * 32}
+
+        with patch('builtins.print') as print_mock:
+            amv.main()
+
+        self.digests_of_path_mock.assert_called_once_with(ANY, {'crc32', 'md5'})
+        print_mock.assert_any_call('Warning: CRC32 of [Group] Show - 01 [1080p][ABCD1234].mkv is DEADBEEF, '
+                                   'but the file name says ABCD1234')
+        queue_mock.return_value.put.assert_has_calls([
+            call({
+                **_create_file_info('[Group] Show - 01 [1080p][ABCD1234].mkv'),
+                'crc32': 'deadbeef',
+                'md5': '2' * 32
+            }),
+            call(None),
+        ])
+
+    @patch('sys.argv', ['amv', '-n', 'file1'])
+    def test_files_handed_over_when_session_is_held(self):
+        with coordination.SessionLock(coordination.LOCK_PATH) as session_lock:
+            session_lock.try_acquire()
+            amv.main()
+
+        self.client_mock.assert_not_called()
+        self.add_queued_files_mock.assert_has_calls([call(ANY, [_create_file_info('file1')])])
+
+    @patch('sys.argv', ['amv', '-n', '--watch', 'dir1'])
+    def test_watch_takes_over_session(self):
+        try_acquire = coordination.SessionLock.try_acquire
+        nr_calls = []
+
+        def try_acquire_after_first_call(session_lock):
+            nr_calls.append(None)
+            return len(nr_calls) > 1 and try_acquire(session_lock)
+
+        with patch('amv.watch.watch_directories', return_value=[]), \
+                patch.object(coordination.SessionLock, 'try_acquire', autospec=True,
+                             side_effect=try_acquire_after_first_call):
+            amv.main()
+
+        self.client_mock.assert_called_once()
+
+    @patch('sys.argv', ['amv', '-n', 'file1', 'file2'])
+    def test_files_in_mylist_skipped_before_login(self):
+        self.is_in_mylist_mock.return_value = True
+
+        amv.main()
+
+        self.client_mock.assert_not_called()
+
+    @patch('sys.argv', ['amv', '-n', '--watch', 'dir1'])
+    def test_watch_adds_files_not_found_right_away(self):
+        def register_file_infos():
+            on_file_not_found = self.client_mock.call_args.args[-1]
+            on_file_not_found(_create_file_info('dir1/file1'))
+            self.add_unregistered_files_mock.assert_called_once_with(ANY, [_create_file_info('dir1/file1')])
+            return []
+
+        client = self.client_mock.return_value.__enter__.return_value
+        client.register_file_infos.side_effect = register_file_infos
+        with patch('amv.watch.watch_directories', return_value=[]):
+            amv.main()
+
+        self.add_unregistered_files_mock.assert_called_once()
+
+    def test_handed_over_files_polled_with_one_connection(self):
+        self.pop_queued_files_mock.return_value = [_create_file_info('/tmp/file1')]
+        stop_event = MagicMock()
+        stop_event.wait.side_effect = [False, False, True]
+        file_info_queue = Queue()
+
+        with patch('amv.database.has_queued_files', side_effect=[False, True]), \
+                patch('amv.database.open_database') as open_database_mock:
+            amv._receive_handed_over_files(stop_event, file_info_queue)
+
+        open_database_mock.assert_called_once()
+        self.pop_queued_files_mock.assert_called_once()
+        self.assertEqual(file_info_queue.get_nowait(), _create_file_info('/tmp/file1'))
+
+    @patch('sys.argv', ['amv', 'file1', 'dir'])
+    def test_files_handed_over_after_moving(self):
+        with coordination.SessionLock(coordination.LOCK_PATH) as session_lock:
+            session_lock.try_acquire()
+            amv.main()
+
+        self.move_mock.assert_has_calls([call('file1', 'dir')])
+        self.add_queued_files_mock.assert_has_calls([call(ANY, [_create_file_info('dir/file1')])])
+
+    @patch('sys.argv', ['amv', '-n', 'file1'])
+    def test_handed_over_files_registered(self):
+        self.pop_queued_files_mock.side_effect = [[_create_file_info('/tmp/file2')], []]
+        client = self.client_mock.return_value.__enter__.return_value
+        client.register_file_infos.side_effect = [[], [_create_file_info('/tmp/file2')]]
+
+        amv.main()
+
+        self.assertEqual(self.client_mock.call_count, 2)
+        self.add_unregistered_files_mock.assert_has_calls([call(ANY, [_create_file_info('/tmp/file2')])])
+
+    @patch('sys.argv', ['amv', '-n', 'dir1'])
+    @patch('amv.amv.Queue')
+    def test_stale_files_pruned_before_report(self, queue_mock):
+        queue_mock.return_value.get.return_value = None
+        self.get_unregistered_files_mock.return_value = [
+            _create_file_info('/tmp/file1', id_=1),
+            {**_create_file_info('/mnt/external/file2', id_=2), 'internal': False},
+            _create_file_info('/tmp/file3', id_=3),
+        ]
+        self.is_stale_mock.side_effect = lambda file_info: file_info['path'] != '/tmp/file3'
+
+        amv.main()
+
+        self.remove_files_mock.assert_has_calls([call(ANY, [1])])
+        queue_mock.return_value.put.assert_has_calls([
+            call(_create_file_info('/tmp/file3', id_=3)),
+            call(_create_file_info('dir1/child_file1')),
+        ])
+
+    def test_renamed_file_kept_in_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'new.mkv')
+            with open(path, 'wb') as file_:
+                file_.write(b'data')
+            file_info = {
+                **_create_file_info(os.path.join(directory, 'old.mkv'), id_=1), **file_identity.get_identity(path)
+            }
+            self.get_unregistered_files_mock.return_value = [file_info]
+            self.is_stale_mock.side_effect = lambda file_info: not os.path.exists(file_info['path'])
+            client = self.client_mock.return_value.__enter__.return_value
+            client.register_file_infos.return_value = [{**file_info, 'path': path}]
+
+            with patch('sys.argv', ['amv', '-n', path]), patch('os.path.isdir', return_value=False), \
+                    patch('amv.database.update_identities') as update_identities_mock:
+                amv.main()
+
+        update_identities_mock.assert_called_once_with(ANY, [{**file_info, 'path': path}])
+        self.digests_of_path_mock.assert_not_called()
+        self.remove_files_mock.assert_not_called()
+        self.add_unregistered_files_mock.assert_not_called()
+
+
+class HashingTest(TestCase):
+    def test_crc32_tag_of_path(self):
+        test_data = [
+            ('/dir/[Group] Show - 01 [1080p][ABCD1234].mkv', 'abcd1234'),
+            ('/dir/Show - 01 (0123abcd).mkv', '0123abcd'),
+            ('/dir/Show - 01.mkv', None),
+            ('/dir/[ABCD1234]/Show - 01.mkv', None),
+            ('/dir/Show - 01 [ABCD1234).mkv', None),
+            ('/dir/Show - 01 (ABCD1234].mkv', None),
+            ('/dir/Show - 01 [20240101].mkv', None),
+            ('/dir/Show - 01 [20240101][ABCD1234].mkv', 'abcd1234'),
+        ]
+
+        for path, expected in test_data:
+            with self.subTest(path=path):
+                self.assertEqual(expected, hashing.crc32_tag_of_path(path))
+
+    def test_crc32(self):
+        crc32 = hashing.DIGESTS['crc32']()
+        crc32.update(b'123456789')
+        self.assertEqual('cbf43926', crc32.hexdigest())
+
+
+class CoordinationTest(TestCase):
+    def test_session_lock(self):
+        with tempfile.TemporaryDirectory() as directory:
+            lock_path = os.path.join(directory, 'amv.lock')
+            with coordination.SessionLock(lock_path) as session_lock, \
+                    coordination.SessionLock(lock_path) as other_session_lock:
+                self.assertIsNone(session_lock.read_rate_limit_state())
+                self.assertTrue(session_lock.try_acquire())
+                self.assertFalse(other_session_lock.try_acquire())
+
+                session_lock.write_rate_limit_state({'nr_free_packets': 3})
+                session_lock.release()
+
+                self.assertTrue(other_session_lock.try_acquire())
+                self.assertEqual(other_session_lock.read_rate_limit_state(), {'nr_free_packets': 3})
+
+
+class FileIdentityTest(TestCase):
+    def test_is_stale(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'file')
+            with open(file_path, 'wb') as file_:
+                file_.write(b'data')
+            file_info = {**_create_file_info(file_path), **file_identity.get_identity(file_path)}
+
+            self.assertFalse(file_identity.is_stale(file_info))
+            self.assertFalse(file_identity.is_stale({**file_info, 'inode': file_info['inode'] + 1}))
+            self.assertFalse(file_identity.is_stale({**file_info, 'path': 'missing'}))
+            self.assertTrue(file_identity.is_stale({**file_info, 'path': os.path.join(directory, 'missing')}))
+
+    def test_has_changed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'file')
+            with open(file_path, 'wb') as file_:
+                file_.write(b'data')
+            file_info = {**_create_file_info(file_path), **file_identity.get_identity(file_path)}
+
+            self.assertFalse(file_identity.has_changed(file_info))
+            self.assertFalse(file_identity.has_changed(_create_file_info(file_path)))
+            self.assertTrue(file_identity.has_changed({**file_info, 'inode': file_info['inode'] + 1}))
+
+
+class ManifestTest(TestCase):
+    def test_write_and_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'file\twith tab')
+            with open(file_path, 'wb') as file_:
+                file_.write(b'data')
+            manifest_path = os.path.join(directory, 'manifest.tsv')
+            with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+                manifest.write_entry(manifest_file, manifest_path, {'path': file_path, 'size': 4, 'ed2k': '1' * 32})
+            with open(manifest_path, encoding='utf-8') as manifest_file:
+                self.assertTrue(manifest_file.read().endswith('\tfile\twith tab\n'))
+
+            entries = manifest.read_manifest(manifest_path)
+            self.assertEqual(entries, [{
+                'size': 4, 'ed2k': '1' * 32, 'mtime': int(os.path.getmtime(file_path)), 'path': file_path,
+                'relative_path': 'file\twith tab'
+            }])
+            self.assertTrue(manifest.matches_local_file(entries[0]))
+            self.assertFalse(manifest.matches_local_file({**entries[0], 'size': 5}))
+
+
+class MylistTest(TestCase):
+    def _read_export(self, content):
+        with tempfile.TemporaryDirectory() as directory:
+            export_path = os.path.join(directory, 'mylist.txt')
+            with open(export_path, 'w', encoding='utf-8') as file_:
+                file_.write(content)
+            return mylist.read_mylist_export(export_path)
+
+    def test_ed2k_links(self):
+        self.assertEqual(
+            self._read_export(
+                'Show - 01 ed2k://|file|Show_-_01.mkv|1337|' + 'A' * 32 + '|/\n'
+                'Show - 02 ed2k://|file|Show_-_02.mkv|42|' + 'b' * 32 + '|/\n'
+            ),
+            [('a' * 32, 1337), ('b' * 32, 42)]
+        )
+
+    def test_csv(self):
+        self.assertEqual(
+            self._read_export('Name\tSize\tEd2k\nShow - 01\t1337\t' + 'A' * 32 + '\n'),
+            [('a' * 32, 1337)]
+        )
+
+    def test_csv_without_ed2k(self):
+        for content in ['Name,Size,Ed2k\nShow - 01,1337,\n', 'Name,Ed2k,Size\nShow,' + 'a' * 32 + '\n']:
+            with self.subTest(content=content), self.assertRaises(exceptions.MylistExportException):
+                self._read_export(content)
+
+
+class WatchTest(TestCase):
+    def test_written_file_is_yielded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shutdown_event = Event()
+            files = watch.watch_directories([directory], shutdown_event, settle_time=0)
+            os.mkdir(os.path.join(directory, 'subdir'))
+            for file_name in ['file.part', 'subdir/file']:
+                with open(os.path.join(directory, file_name), 'wb') as file_:
+                    file_.write(b'data')
+
+            self.assertEqual(next(files), os.path.join(directory, 'subdir', 'file'))
+            shutdown_event.set()
+            self.assertEqual(list(files), [])
+
+
+class UdpClientTest(TestCase):
+    @patch('time.sleep')
+    def test_file_not_found_after_timeouts_in_watch_mode(self, _):
+        file_info = _create_file_info('file1')
+        queue = Queue()
+        for item in [file_info, None]:
+            queue.put(item)
+        files_not_found = []
+        client = UdpClient(Event(), False, {'username': 'user', 'password': 'pass'}, queue,
+                           on_file_not_found=files_not_found.append)
+        client._socket = MagicMock()
+        client._socket.recvfrom.side_effect = [
+            socket.timeout(), BlockingIOError(), (b'200 session LOGIN ACCEPTED', None), socket.timeout()
+        ]
+
+        self.assertEqual(client.register_file_infos(), [])
+        self.assertEqual(files_not_found, [file_info])
+
 
 class AmvDbTest(TestCase):
     def test_format_timestamp(self):
@@ -184,6 +566,82 @@ class DatabaseTest(TestCase):
         with database.open_database(':memory:') as cursor:
             self.assertEqual([], database.get_unregistered_files(cursor))
 
+    def test_old_database_gets_new_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database_path = os.path.join(directory, 'amv.sqlite3')
+            connection = sqlite3.connect(database_path)
+            connection.execute('create table unregistered_files ('
+                               'view_date datetime, watched boolean, internal boolean,'
+                               'ed2k varchar(32), size integer, path text)')
+            connection.execute('insert into unregistered_files values (?, 1, 1, ?, 1337, ?)',
+                               (1532983833.2112887, '1' * 32, '/tmp/file1'))
+            connection.commit()
+            connection.close()
+
+            with database.open_database(database_path) as cursor:
+                self.assertEqual(
+                    database.get_unregistered_files(cursor),
+                    [_create_file_info('/tmp/file1', id_=1)]
+                )
+
+    def test_mylist(self):
+        with database.open_database(':memory:') as cursor:
+            database.add_mylist_files(cursor, [('1' * 32, 1337), ('1' * 32, 1337), ('2' * 32, 42)])
+
+            self.assertTrue(database.is_in_mylist(cursor, '1' * 32, 1337))
+            self.assertTrue(database.is_in_mylist(cursor, '2' * 32, 42))
+            self.assertFalse(database.is_in_mylist(cursor, '1' * 32, 42))
+
+    def test_queued_files(self):
+        with database.open_database(':memory:') as cursor:
+            self.assertFalse(database.has_queued_files(cursor))
+            database.add_queued_files(cursor, [_create_file_info('/tmp/file1'), _create_file_info('/tmp/file2')])
+
+            self.assertTrue(database.has_queued_files(cursor))
+            self.assertEqual(
+                database.pop_queued_files(cursor),
+                [_create_file_info('/tmp/file1'), _create_file_info('/tmp/file2')]
+            )
+            self.assertFalse(database.has_queued_files(cursor))
+
+    def test_moved_file_updated(self):
+        with database.open_database(':memory:') as cursor:
+            identity = {'dev': 1, 'inode': 2, 'mtime': 1532983833.5}
+            database.add_unregistered_files(cursor, [{**_create_file_info('/tmp/file1'), **identity}])
+            database.add_unregistered_files(cursor, [{**_create_file_info('/tmp/dir/file1'), **identity}])
+
+            self.assertEqual(
+                database.get_unregistered_files(cursor),
+                [{**_create_file_info('/tmp/dir/file1', id_=1), **identity}]
+            )
+
+    def test_file_digests(self):
+        with database.open_database(':memory:') as cursor:
+            database.add_file_digests(cursor, [
+                {**_create_file_info('/tmp/file1'), 'crc32': 'abcd1234', 'md5': '2' * 32}
+            ])
+            database.add_file_digests(cursor, [{**_create_file_info('/tmp/dir/file1'), 'sha1': '3' * 40}])
+
+            self.assertEqual(database.get_file_digests(cursor), [{
+                'ed2k': '1' * 32,
+                'size': 1337,
+                'path': '/tmp/dir/file1',
+                'crc32': 'abcd1234',
+                'md5': '2' * 32,
+                'sha1': '3' * 40,
+            }])
+
+    def test_update_identities(self):
+        with database.open_database(':memory:') as cursor:
+            database.add_unregistered_files(cursor, [_create_file_info('/tmp/file1')])
+            identity = {'dev': 1, 'inode': 2, 'mtime': 1532983833.5}
+            database.update_identities(cursor, [{**_create_file_info('/tmp/file2', id_=1), **identity}])
+
+            self.assertEqual(
+                database.get_unregistered_files(cursor),
+                [{**_create_file_info('/tmp/file2', id_=1), **identity}]
+            )
+
     def test_crud(self):
         with database.open_database(':memory:') as cursor:
             database.add_unregistered_files(